@@ -1,146 +1,186 @@
-import csv
-from mpmath import *
 import subprocess
 import os
 import re
+import argparse
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib
-matplotlib.use('TkAgg')
+matplotlib.use('Agg') # non-interactive backend for batch/headless runs; see --backend and --show below
 import matplotlib.pyplot as plt
-import pdb
-import yaml
-import math
 import pandas as pd
 
 ## This function runs statistics on the runs accessed (i.e. parameter sweep). Then it collects the relevant data and plots it at the end
 
-def process_sweep(sweep_array, dir_prefix, data_filename, _isCleaning):
+_gce_estimator_re = re.compile('gce-estimator')
+_plot_style_file = '/home/emcgarrigle/CSBosonsCpp/tools/Figs_scripts/plot_style_orderparams.txt'
+
+@functools.lru_cache(maxsize=None)
+def _load_style(path):
+  # -- Parses a matplotlib style file (only the parameters it sets); memoized so the file is only read once per session -- 
+  return matplotlib.rc_params_from_file(path, use_default_template=False)
+
+@functools.lru_cache(maxsize=None)
+def _find_estimator(path):
+  # -- Returns the (first) gce-estimator filename in path; memoized so each directory is only scanned once -- 
+  # os.scandir gets the file type from the directory read itself, so there is no extra stat per entry 
+  # A failed scan raises (and lru_cache does not cache exceptions), so the directory is rescanned next time 
+  with os.scandir(path) as entries:
+    name = next((f.name for f in entries if f.is_file() and _gce_estimator_re.search(f.name)), None)
+  if name is None:
+    raise FileNotFoundError(f'no gce-estimator file in {path}')
+  return name
+
+def _output_paths(sweep_array, dir_prefix):
+  # -- Returns the OUTPUT directory (as a Path) of the run for each sweep value, e.g. dtau_0.01/OUTPUT -- 
+  return [Path(f'{dir_prefix}_{p_}') / 'OUTPUT' for p_ in sweep_array]
+
+def _process_one(path, data_filename, _isCleaning):
+  # -- Runs pimcave.py in the OUTPUT directory (path) of a single sweep value; independent of the other sweep values -- 
+
+  # Each call runs in its own thread, so every message is a single line that names its directory 
+  if(_isCleaning):
+    print(f'Removing old processed file {path / data_filename}')
+    (path / data_filename).unlink(missing_ok=True)
 
-  # Loop through the tau directories and run the processing script 
-  for i, p_ in enumerate(sweep_array):
+  # read the gce-estimator filename 
+  gce_estimator_file = _find_estimator(path)
 
-  
-    outer_dir_name = dir_prefix + '_' + str(p_) 
-  
-    # In each directory, run pimcave.py to generate avg + std-error  
-    path = './' + outer_dir_name + '/OUTPUT/'
-
-    if(_isCleaning):
-      print()
-      print('Removing old processed files')
-      print()
-      subprocess.call('rm ' + path + data_filename, shell=True) 
-
-    print('Processing the directory: ')
-    print(path)  
-    print()
-    print()
-    # read the gce-estimator filename 
-    dirlist = os.listdir(path)
-    filenames = [item for item in dirlist if os.path.isfile(os.path.join(path, item) ) ]
-    #print(filenames)
-    gce_estimator_file = [name for name in filenames if 'gce-estimator' in name]
-    gce_estimator_file = gce_estimator_file[0] 
-    print()
-    print('Processing ' + gce_estimator_file)
-    print()
-
-    #python_process_cmd = 'pimcave.py ' + path + gce_estimator_file + ' > ' + path + 'tmp.dat' 
-    tail_cmd = 'tail -n +3 > ' 
-    # This command will run pimcave on the gce-estimator file in the path and pipe the output to tail, which cuts the first two lines, stores resulting data
-    python_process_cmd = 'pimcave.py ' + path + gce_estimator_file + ' | ' + tail_cmd + path + data_filename 
-    subprocess.call(python_process_cmd, shell = True) # runs the python command 
-  
-    
-def extract_observables(sweep_array, dir_prefix, data_filename, _isCleaning):
+  # data.dat is still up to date if it is newer than the estimator file, so skip pimcave (this keeps the data.npz cache valid) 
+  dst = path / data_filename
+  if dst.exists() and dst.stat().st_mtime >= (path / gce_estimator_file).stat().st_mtime:
+    print(f'Skipping {path / gce_estimator_file} ({data_filename} is up to date)')
+    return
 
-  # -- Function for extracting the observables calculated from pimcave.py (from the process_sweep fxn above) --  
+  print(f'Processing {path / gce_estimator_file}')
 
-  # Loop through the tau directories, extract the observables  
-  sample_data = './' + dir_prefix + '_' + str(sweep_array[0]) + '/OUTPUT/' + data_filename
+  # Run pimcave on the gce-estimator file in the path (no shell) and stream its output, cutting the first two (header) lines, into a temporary file 
+  #   - the temporary file only replaces the data file if pimcave succeeds, so a failed run never leaves a truncated (but "up to date") data file 
+  pimcave_cmd = ['pimcave.py', gce_estimator_file]
+  tmp = dst.with_suffix('.tmp')
+  try:
+    with subprocess.Popen(pimcave_cmd, cwd=str(path), stdout=subprocess.PIPE, text=True) as p, open(tmp, 'w') as out:
+      for n, line in enumerate(p.stdout):
+        if n >= 2:
+          out.write(line)
+
+    if p.returncode != 0:
+      raise subprocess.CalledProcessError(p.returncode, pimcave_cmd)
+  except BaseException:
+    tmp.unlink(missing_ok=True)
+    raise
+
+  os.replace(tmp, dst)
+
+
+def process_sweep(sweep_array, dir_prefix, data_filename, _isCleaning):
 
-  # read the first column (observable names) from the sample pimcave output
-  get_obs_list_cmd = "cut -d ' ' -f 1 " + sample_data + " > ./observables_list.dat"
+  # Process the tau directories concurrently; threads suffice since each worker just waits on pimcave.py and file IO 
+  paths = _output_paths(sweep_array, dir_prefix)
+  if not paths:
+    return
+  with ThreadPoolExecutor(max_workers = min(8, len(paths))) as ex:
+    list(ex.map(lambda path: _process_one(path, data_filename, _isCleaning), paths))
+  
+    
+def _load_means_errs(path, data_filename, obs_list, _isCleaning):
+  # -- Returns the (obs_list, means, errs) of a pimcave output file, using a binary .npz sidecar (e.g. data.npz) as a cache -- 
+  #    The cache stores the observable names with the data and is only used if it is at least as new as the text file 
+  #    and lists the same observables; otherwise the text file is parsed and the cache rewritten 
+  #    obs_list is the (shared) list of observable names; every file must list the same observables in the same order 
+  #    Pass obs_list = None for the first file, which then defines the list 
+  #    Since process_sweep only reruns pimcave.py when the estimator file has changed, data.dat (and so the cache) stays valid between runs 
+  src = path / data_filename
+  cache = src.with_suffix('.npz')
 
   if(_isCleaning):
-    subprocess.call('rm ./observables_list.dat', shell=True)
+    cache.unlink(missing_ok=True)
+
+  data = None
+  if cache.exists() and cache.stat().st_mtime >= src.stat().st_mtime:
+    with np.load(cache) as cached:
+      cached_obs = cached['obs'].tolist()
+      if obs_list is None or cached_obs == obs_list:
+        obs_list = cached_obs
+        data = cached['data']
+
+  if data is None:
+    # import the data: columns are (observable name, mean, error), separated by whitespace 
+    #   - observable names are kept exactly as written (no NA parsing, so e.g. an observable called NA does not become nan) 
+    df = pd.read_csv(src, sep=r'\s+', header=None, usecols=[0, 1, 2], names=['obs', 'mean', 'err'], dtype={'obs': str}, keep_default_na=False, engine='c')
+    if obs_list is None:
+      obs_list = df['obs'].tolist()
+    elif df['obs'].tolist() != obs_list:
+      raise ValueError('The observables in ' + str(src) + ' do not match those of the first sweep directory')
+    data = np.stack([df['mean'].to_numpy(dtype=float), df['err'].to_numpy(dtype=float)])
+    np.savez(cache, obs=np.array(obs_list), data=data)
+
+  return obs_list, data[0], data[1]
 
-  subprocess.call(get_obs_list_cmd, shell=True)
 
-  print('Observables: ')
-  with open('./observables_list.dat', 'r') as f:
-    obs_list = [line.strip() for line in f] # strip() removes excess space
-    print(obs_list)
+def extract_observables(sweep_array, dir_prefix, data_filename, _isCleaning):
 
-  # obs_list contains the list of observables   
-  # Create data frames using the observable names as keys for 1) the means and 2) the errors 
-  #   - we want a data frame that stores for each obs an array of length(sweep_array) 
-  row_key_list = ['means', 'errors']
-  pimc_output_df = pd.DataFrame(columns = obs_list, index = row_key_list) 
+  # -- Function for extracting the observables calculated from pimcave.py (from the process_sweep fxn above) --  
 
-  for row in row_key_list:
-    pimc_output_df.loc[row] = list( np.zeros( (len(obs_list), len(sweep_array) ) ) )
+  # Loop through the tau directories, extract the observables  
+  paths = _output_paths(sweep_array, dir_prefix)
+  if not paths:
+    return {'obs_index': {}, 'means': np.zeros((0, 0)), 'errors': np.zeros((0, 0))}
 
-  # Check that the data frame has been set up correctly 
-  print(pimc_output_df) 
+  # the first directory's pimcave output defines the observable names; all the other directories are checked against this list 
+  print('- Extracting observables -')
+  obs_list, first_means, first_errs = _load_means_errs(paths[0], data_filename, None, _isCleaning)
 
-  # Loop through each directory and load the data frame with the observable data 
-  for i, p_ in enumerate(sweep_array):
-    outer_dir_name = dir_prefix + '_' + str(p_) + '/OUTPUT' 
-  
-    # In each directory, run pimcave.py to generate avg + std-error  
-    path = './' + outer_dir_name + '/'
-
-    print('- Extracting observables -')
-    #cut_cmd = 'cut -d ' ' -f 2- ' + path + data_filename + ' > tmp.dat'  # removes the first column of observable names (strings) 
-    cut_cmd = "cut -d ' ' -f 1- " # removes the first column of observable names (strings) 
-    #awk_cmd = "awk '{$1=""; sub(/^ +/, ""); $1=$1} 1' OFS=" " tmp.dat > output.txt " # Credit to Chat GPT for this 
-    awk_cmd = 'awk \'{ $1=""; sub(/^ +/, ""); $1=$1} 1\' OFS=" "'  # Credit to Chat GPT for this 
-
-    # pipe the output of the cut_cmd into the awk_cmd to format the data into readable columns with 1 space bt. each entry within a row 
-    # create a formatted data file:  
-    format_data_fname = 'data_formatted.dat'
-    format_cmd = cut_cmd + path + data_filename + ' | ' + awk_cmd + ' > ' + path + format_data_fname 
-    if(_isCleaning):
-      subprocess.call('rm ' + path + format_data_fname, shell=True)
-
-    # run the formatting command 
-    subprocess.call(format_cmd, shell = True) # runs the python command 
-
-    # import the data 
-    data = np.loadtxt(path + format_data_fname, unpack=True)
-    means = data[0]
-    errs = data[1]
+  print('Observables: ')
+  print(obs_list)
 
+  # obs_list contains the list of observables   
+  # Create (len(obs_list), len(sweep_array)) arrays for 1) the means and 2) the errors, and a dict mapping each observable name to its row 
+  #   - row obs_index[O] is then a contiguous array of length(sweep_array) for the observable O 
+  obs_index = {O: j for j, O in enumerate(obs_list)}
+  means = np.zeros((len(obs_list), len(sweep_array)))
+  errs = np.zeros_like(means)
+  means[:, 0], errs[:, 0] = first_means, first_errs
+
+  # Loop through the remaining directories and fill the arrays with the observable data 
+  for i, path in enumerate(paths[1:], start=1):
     # Extract observables
       # jth row of means or errs corresponds to O the observable 
-      # ith entry in the dataframe corresponds to the sweep_array (dtau) value  
-    for j, O in enumerate(obs_list):
-      pimc_output_df.loc['means'][O][i] = means[j] 
-      pimc_output_df.loc['errors'][O][i] = errs[j] 
+      # ith column corresponds to the sweep_array (dtau) value  
+    _, means[:, i], errs[:, i] = _load_means_errs(path, data_filename, obs_list, _isCleaning)
 
+  # Check that the arrays have been filled correctly 
+  print(pd.DataFrame(means.T, index = sweep_array, columns = obs_list)) 
 
-  return pimc_output_df
+  return {'obs_index': obs_index, 'means': means, 'errors': errs}
 
 
 
-def plot_observables(sweep_array, obs_dataframe, obs_to_plot, x_axis_label, y_axis_labels):
-  # Input is the (dtau) sweep array and the dataframe with means and errors of each observables as a fxn of the sweep variable (dtau) 
+def plot_observables(sweep_array, obs_data, obs_to_plot, x_axis_label, y_axis_labels, _isInteractive = False):
+  # Input is the (dtau) sweep array and the dict of arrays (+ obs_index) with means and errors of each observables as a fxn of the sweep variable (dtau) 
   #   "desired_observables" is a list of observables (strings) to plot  
+  #   "_isInteractive" additionally displays each figure (requires an interactive backend, e.g. TkAgg)  
  
   assert(len(obs_to_plot) == len(y_axis_labels)) 
-  plt.style.use('/home/emcgarrigle/CSBosonsCpp/tools/Figs_scripts/plot_style_orderparams.txt') 
+  plt.style.use(_load_style(_plot_style_file)) # style.use (unlike rcParams.update) ignores non-style keys such as backend 
+  # create the figure once and redraw it for each observable 
+  fig, ax = plt.subplots(figsize=(5.0, 5.0))
   for j, O in enumerate(obs_to_plot): 
     fig_filename = O + '_PIMC_tau_sweep.eps'
-    plt.figure(figsize=(5.0, 5.0))
-    plt.errorbar(sweep_array, obs_dataframe.loc['means'][O], obs_dataframe.loc['errors'][O], marker='o', color = 'b', markersize = 6, linewidth = 0.5, label = 'PIMC') 
-    plt.xlabel(x_axis_label, fontsize = 24) 
-    #plt.xlabel(r'$\Delta \tau$',fontsize = 20, fontweight = 'bold')
-    plt.ylabel(y_axis_labels[j], fontsize = 28) 
-    plt.legend()
-    #plt.savefig(fig_filename, dpi=300)
-    plt.show()
+    ax.clear()
+    ax.errorbar(sweep_array, obs_data['means'][obs_data['obs_index'][O]], obs_data['errors'][obs_data['obs_index'][O]], marker='o', color = 'b', markersize = 6, linewidth = 0.5, label = 'PIMC') 
+    ax.set_xlabel(x_axis_label, fontsize = 24) 
+    #ax.set_xlabel(r'$\Delta \tau$',fontsize = 20, fontweight = 'bold')
+    ax.set_ylabel(y_axis_labels[j], fontsize = 28) 
+    ax.legend()
+    fig.savefig(fig_filename, dpi=300)
+    if(_isInteractive):
+      plt.show()
+      # closing the window destroys the figure, so the next observable needs a new one 
+      fig, ax = plt.subplots(figsize=(5.0, 5.0))
 
+  plt.close(fig)
 
 
 if __name__ == '__main__':
@@ -148,6 +188,17 @@ if __name__ == '__main__':
   # -- This function runs a python processing script for a sweep of PIMC runs, with 1 run per directory matching -- 
   # -- Run this function from the parent directory that contains the folder of PIMC runs -- 
 
+  parser = argparse.ArgumentParser(description='Process and plot a sweep of PIMC runs')
+  parser.add_argument('--show', action='store_true', help='display the figures interactively (in addition to saving them)')
+  parser.add_argument('--backend', type=str, default=None, help='matplotlib backend (default: Agg, or TkAgg with --show)')
+  args = parser.parse_args()
+
+  backend = args.backend
+  if backend is None:
+    backend = 'TkAgg' if args.show else 'Agg'
+  if backend.lower() != matplotlib.get_backend().lower():
+    plt.switch_backend(backend)
+
   # 1. Specify the sweep array 
   dtau_list = np.array([0.03, 0.02, 0.01, 0.008, 0.006, 0.004, 0.002, 0.001, 0.0005, 0.0001])
   #dtau_list = dtau_list[1:4]
@@ -161,6 +212,7 @@ if __name__ == '__main__':
   # 4. Additional script inputs 
   _isCleaning = False  # remove any old processing files (data_filename); this does not delete the raw pimc data 
   _isPlotting = True   # make plots?
+  _isInteractive = args.show # display the plots? (they are always saved) 
 
   # 5. list any desired observables (using the appropriate strings) and their corresponding y-axis labels for plotting  
   #      - all observables are extracted; these lists are just for plotting 
@@ -170,10 +222,10 @@ if __name__ == '__main__':
 
   # run the various functions: 
   process_sweep(dtau_list, sweep_var, data_filename, _isCleaning) # run pimcave on all the PIMC runs 
-  stats_dframe = extract_observables(dtau_list, sweep_var, data_filename, _isCleaning)  # extract the observables (means and errors) and put them into a data frame 
+  stats_data = extract_observables(dtau_list, sweep_var, data_filename, _isCleaning)  # extract the observables (means and errors) and put them into arrays 
 
   if(_isPlotting):
-    plot_observables(dtau_list, stats_dframe, desired_observables, x_axis_label, y_axis_labels) 
+    plot_observables(dtau_list, stats_data, desired_observables, x_axis_label, y_axis_labels, _isInteractive) 
 
 
 
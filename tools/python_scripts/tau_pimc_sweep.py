@@ -1,46 +1,40 @@
-import csv
-from mpmath import *
 import subprocess
 import os
-import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import pdb
-import yaml
-import math
 ## This function runs statistics on the runs accessed (i.e. parameter sweep). Then it collects the relevant data and plots it at the end
 
 
 dtau = np.array([0.03, 0.02, 0.01, 0.008, 0.006, 0.004, 0.002, 0.001, 0.0005, 0.0001])
 
-for i, dtau_ in enumerate(dtau):
+submit_script = 'submit.sh'
 
-  outer_dir_name = 'dtau_' + str(dtau_) 
-  # mkdir command
-  str_mkdir = 'mkdir ' + outer_dir_name
-  subprocess.call(str_mkdir, shell = True)
-  # change directory
-  os.chdir(outer_dir_name)
 
-  # copy the submit and inputs and graphing scripts/files 
-  submit_script = 'submit.sh'
-  cp_submit = 'cp ../' + submit_script + ' ./' + submit_script
+def submit_one(dtau_):
+  # -- Sets up the directory for a single dtau value and submits its job; independent of the other dtau values -- 
 
-  sed_command1 = 'sed -i "s/__dtau__/' + str(dtau_) + '/g" ' + submit_script 
+  outer_dir_name = 'dtau_' + str(dtau_) 
+  # mkdir 
+  os.makedirs(outer_dir_name, exist_ok = True)
 
-  jobname = 'pimc_dtau_'  + str(dtau)
-  sed_command_jobname = 'sed -i "s/__jobname__/' + jobname + '/g" ' + submit_script 
-  #qsub_cmd = 'qsub ' + submit_script # for PBS 
-  qsub_cmd = 'sbatch ' + submit_script # for slurm
-  
-  str_list = [cp_submit, sed_command1, sed_command_jobname, qsub_cmd] 
+  # copy the submit and inputs and graphing scripts/files 
+  dst = os.path.join(outer_dir_name, submit_script)
+  shutil.copy(submit_script, dst)
 
-  # execute all the commands in order
-  for s in str_list:
-    subprocess.call(s, shell = True)
+  # fill in the dtau and jobname placeholders of the submit script 
+  jobname = 'pimc_dtau_'  + str(dtau_)
+  with open(dst, 'r') as f:
+    text = f.read()
+  text = text.replace('__dtau__', str(dtau_)).replace('__jobname__', jobname)
+  with open(dst, 'w') as f:
+    f.write(text)
 
-  os.chdir('../')
+  #qsub_cmd = ['qsub', submit_script] # for PBS 
+  qsub_cmd = ['sbatch', submit_script] # for slurm
+  subprocess.run(qsub_cmd, cwd = outer_dir_name, check = True)
 
 
+# submit all the jobs concurrently (no os.chdir, so each submission is independent) 
+with ThreadPoolExecutor(max_workers = 8) as ex:
+  list(ex.map(submit_one, dtau))